@@ -3,11 +3,14 @@ Sample script to extract transaction data from an affiliate network API
 '''
 
 import datetime as dt
-from copy import deepcopy
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Iterable, Iterator
 
+import ijson
+import redis
+from cachetools import TTLCache
 from flask import current_app as app
-from googleapiclient.discovery import Resource
 
 from sample_framework import IterativePipeline, Pipeline
 from sample_framework.steps import PipelineStep, RedshiftCopy, S3Upload
@@ -91,12 +94,39 @@ COLUMN_MAP = {
     }
 }
 
+# Row templates and source-field pairs resolved once at import
+# rather than rebuilt for every record
+_TX_TEMPLATE = dict.fromkeys(COLUMN_MAP['transactions'])
+_TX_SOURCE_FIELDS = [(field, source)
+                     for field, source in COLUMN_MAP['transactions'].items()
+                     if source]
+_PROD_TEMPLATE = dict.fromkeys(COLUMN_MAP['products'])
+_PROD_SHARED_FIELDS = [field for field in COLUMN_MAP['products']
+                       if field in COLUMN_MAP['transactions']]
+
 SERVICE_NAME = 'sheets'
 VERSION = 'v4'
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEETID = 'sample_spreadsheet_id'
 DATA_RANGE = 'sample_data_range'
 
+# The closed-retailers sheet changes rarely, so cache it for an hour
+# instead of hitting the Sheets API on every pipeline iteration
+_CLOSED_RETAILER_CACHE = TTLCache(maxsize=1, ttl=3600)
+
+# Retailers discovered from the advertiser-details endpoint are
+# persisted per country in a Redis hash so iterations (and restarts)
+# start with a warm map; the daily expiry lets renames propagate
+_REDIS = redis.Redis.from_url(app.config['REDIS_URL'], decode_responses=True)
+RETAILER_MAP_TTL = 86400
+
+
+def _retailer_map_key(country: str) -> str:
+    '''
+    Redis key holding the persisted retailer map for a country
+    '''
+    return f'retailer_map:{AFF_NETWORK}:{country}'
+
 
 def get_user_id(country: str) -> str:
     '''
@@ -114,6 +144,52 @@ def get_access_token(country: str) -> str:
     return CREDENTIALS.get(token_key)
 
 
+@lru_cache(maxsize=4096)
+def _parse_referring_url(url: str) -> tuple:
+    '''
+    Resolve the canonical article and domain for a referring URL in one
+    call. Cached because many transactions share a referrer, so each
+    unique URL is only parsed once instead of twice per row.
+    '''
+    return adt.get_canonical(url), adt.get_site(url)
+
+
+@lru_cache(maxsize=4096)
+def _fetch_retailer(advertiser_id: int, country: str) -> str:
+    '''
+    Look up a retailer name from the advertiser details endpoint.
+    Memoized so repeated advertiser ids only cost one HTTP round trip
+    across pipeline iterations.
+    '''
+    # Base api url for advertiser details
+    advertiser_url = 'https://api.sample-network.com/publishers/{0}/programmedetails'
+
+    user_id = get_user_id(country)
+    request_url = advertiser_url.format(user_id)
+
+    # Set request params
+    params = {
+        'advertiserId': advertiser_id,
+        'accessToken': get_access_token(country)
+    }
+
+    # Send request
+    response = request_with_retries('GET', request_url, params=params)
+    if response.status_code != 200:
+        response.raise_for_status()
+
+    json_response = response.json()
+
+    # Grab retailer name
+    try:
+        raw_retailer_name = json_response['programmeInfo']['name']
+    except (TypeError, KeyError) as e:
+        raise KeyError(
+            'no retailer info for advertiser ID: {0}'.format(advertiser_id))
+
+    return raw_retailer_name.lower()
+
+
 class Init(PipelineStep):
     def run(self, report_date: str, country: str) -> dict:
         '''
@@ -126,8 +202,7 @@ class Init(PipelineStep):
         # Closed retailer accounts cause the program
         # info endpoint to return null so their ids are
         # stored here until all old transactions have posted
-        sheets = self._get_sheets_service()
-        retailer_map = self._get_closed_retailers(sheets)
+        retailer_map = self._get_closed_retailers() or {}
 
         # Convert country into upper cased
         if country:
@@ -135,6 +210,13 @@ class Init(PipelineStep):
                 raise AttributeError('Country should be US or UK.')
             country = country.upper()
 
+        # Warm the map with retailers persisted from previous runs
+        key = _retailer_map_key(country)
+        retailer_map.update(_REDIS.hgetall(key))
+        if retailer_map:
+            _REDIS.hset(key, mapping=retailer_map)
+            _REDIS.expire(key, RETAILER_MAP_TTL)
+
         self.log_message(
             f'starting extraction for {country}: {start} to {end}')
 
@@ -157,10 +239,17 @@ class Init(PipelineStep):
         )
         return client.spreadsheets().values()
 
-    def _get_closed_retailers(self, service: Resource) -> dict:
+    def _get_closed_retailers(self) -> dict:
         '''
-        Retrieve list of closed retailers from Google Sheets
+        Retrieve list of closed retailers from Google Sheets,
+        cached for an hour across pipeline iterations. Client
+        construction sits behind the cache too, since it triggers
+        an OAuth token refresh.
         '''
+        if 'retailers' in _CLOSED_RETAILER_CACHE:
+            return _CLOSED_RETAILER_CACHE['retailers']
+
+        service = self._get_sheets_service()
         self.log_message('getting names from Google Sheets')
         response = service.get(
             spreadsheetId=SPREADSHEETID,
@@ -172,6 +261,7 @@ class Init(PipelineStep):
         if result:
             fields = result.pop(0)
             retailers = {row[0]: row[1] for row in result}
+            _CLOSED_RETAILER_CACHE['retailers'] = retailers
             return retailers
 
 
@@ -196,14 +286,24 @@ class Extract(PipelineStep):
             'accessToken': get_access_token(country)
         }
 
-        # Send request
+        # Send request, streaming the body so records are parsed
+        # incrementally instead of buffering the full response text
         self.log_message('sending request...')
-        response = request_with_retries('GET', request_url, params=params)
+        response = request_with_retries(
+            'GET', request_url, params=params, stream=True)
         if response.status_code != 200:
             response.raise_for_status()
 
+        # The raw stream carries the wire bytes; decode any
+        # Content-Encoding (gzip/deflate) so ijson sees plain JSON
+        response.raw.decode_content = True
+
+        # use_float keeps fractional amounts as floats, matching
+        # response.json(); ijson's default Decimals are not
+        # serializable by json or orjson at the upload boundary
         return {
-            'raw_extract': response.json()
+            'raw_extract': list(
+                ijson.items(response.raw, 'item', use_float=True))
         }
 
 
@@ -221,7 +321,10 @@ class Transform(PipelineStep):
         processed = self._process_transaction_status(
             raw_extract, existing_transactions, country)
 
-        # Transform data and prepare formatting for S3Upload step
+        # Transform data and prepare formatting for S3Upload step;
+        # _process_transaction_status yields lazily so status handling
+        # and formatting run as one fused pass over the records
+        self._prefetch_retailers(raw_extract, country, retailer_map)
         reports = self._transform_data(processed, country, retailer_map)
         raw_data = {f'{AFF_NETWORK}_{country}_transactions': raw_extract}
         transformed_data = [
@@ -238,44 +341,83 @@ class Transform(PipelineStep):
             'raw_data': raw_data
         }
 
-    def _transform_data(self, data: list, country: str, retailer_map: dict) -> dict:
+    def _transform_data(self, data: Iterable[dict], country: str, retailer_map: dict) -> dict:
         '''
         Standardizing data for affiliate data tables
         '''
         self.log_message('transforming data...')
         transformed_transactions = []
         transformed_products = []
+        # Bind hot callables to locals so the per-record loop skips
+        # repeated attribute lookups on self and the output lists
+        format_transaction = self._format_transaction
+        format_product = self._format_product
+        copy_transaction = _TX_TEMPLATE.copy
+        copy_product = _PROD_TEMPLATE.copy
+        add_transaction = transformed_transactions.append
+        add_product = transformed_products.append
         for entry in data:
-            transaction = dict((key, None)
-                               for key in COLUMN_MAP['transactions'])
-            for field in transaction:
-                if COLUMN_MAP['transactions'][field]:
-                    transaction[field] = entry[COLUMN_MAP['transactions'][field]]
-            formatted_transaction = self._format_transaction(
+            transaction = copy_transaction()
+            for field, source in _TX_SOURCE_FIELDS:
+                transaction[field] = entry[source]
+            formatted_transaction = format_transaction(
                 transaction, entry, country, retailer_map)
-            transformed_transactions.append(formatted_transaction)
+            add_transaction(formatted_transaction)
             if entry['basketProducts']:
                 # product entries are under basketProducts as a list of dicts
                 for prod_entry in entry['basketProducts']:
-                    product = dict((key, None)
-                                   for key in COLUMN_MAP['products'])
-                    for field in product:
-                        if field in formatted_transaction:
-                            product[field] = formatted_transaction[field]
-                    formatted_product = self._format_product(
-                        product, prod_entry)
-                    transformed_products.append(formatted_product)
-        reports = {'transactions': adt.fill_none(transformed_transactions),
-                   'products': adt.fill_none(transformed_products)}
+                    product = copy_product()
+                    for field in _PROD_SHARED_FIELDS:
+                        product[field] = formatted_transaction[field]
+                    add_product(format_product(product, prod_entry))
+        # The row templates are built with dict.fromkeys, so every
+        # record already carries the full column set with None defaults
+        # and the adt.fill_none pass is redundant
+        reports = {'transactions': transformed_transactions,
+                   'products': transformed_products}
         return reports
 
-    def _process_transaction_status(self, new_records: list, existing_records: list, country: str) -> List[dict]:
+    def _prefetch_retailers(self, data: list, country: str, retailer_map: dict) -> None:
+        '''
+        Resolve unknown advertiser ids concurrently before the transform
+        loop so record formatting only ever hits the in-memory map
+        instead of blocking on a network round trip per miss.
+        '''
+        unknown = list({str(entry['advertiserId'])
+                        for entry in data} - retailer_map.keys())
+        if not unknown:
+            return
+        self.log_message(f'fetching {len(unknown)} unknown retailers...')
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            names = executor.map(
+                lambda aid: _fetch_retailer(int(aid), country), unknown)
+            discovered = dict(zip(unknown, names))
+        retailer_map.update(discovered)
+        # Persist the discoveries so later iterations skip the lookups
+        _REDIS.hset(_retailer_map_key(country), mapping=discovered)
+
+    def _clone_for_return(self, record: dict) -> dict:
+        '''
+        Shallow-copy a transaction record along with the nested fields
+        that get mutated when building return records. Untouched fields
+        stay aliased, which is far cheaper than a full deepcopy.
+        '''
+        clone = record.copy()
+        clone['saleAmount'] = record['saleAmount'].copy()
+        clone['commissionAmount'] = record['commissionAmount'].copy()
+        if record.get('basketProducts'):
+            clone['basketProducts'] = [product.copy()
+                                       for product in record['basketProducts']]
+        return clone
+
+    def _process_transaction_status(self, new_records: list, existing_records: list, country: str) -> Iterator[dict]:
         '''
         This network only provides the latest snapshot of data, so we have to recreate
         the original transaction records when we receive records with returns.
+        Yields records lazily so the transform loop consumes them without
+        materializing an intermediate list.
         '''
         self.log_message('creating original transactions for returns')
-        output_records = list()
         for new_record in new_records:
             if str(new_record['id']) in existing_records:
                 adt.delete_transaction_record(
@@ -285,45 +427,46 @@ class Transform(PipelineStep):
                         adt.delete_product_record(
                             new_record['id'], product['productId'], AFF_NETWORK.replace('-', ' '), country)
             if new_record['commissionStatus'] == 'declined':
-                return_record = deepcopy(new_record)
+                return_record = self._clone_for_return(new_record)
                 return_record['saleAmount']['amount'] = new_record['saleAmount']['amount'] * -1
                 return_record['commissionAmount']['amount'] = new_record['commissionAmount']['amount'] * -1
                 if return_record['basketProducts']:
                     for product_record in return_record['basketProducts']:
                         product_record['quantity'] *= -1
-                output_records.append(new_record)
-                output_records.append(return_record)
+                yield new_record
+                yield return_record
 
             elif (
                 new_record['commissionStatus'] == 'approved' and
                 new_record['amended'] and
                 new_record['oldSaleAmount']['amount'] != new_record['saleAmount']['amount']
             ):
+                # Read each nested amount once instead of chasing the
+                # same dict paths for every calculation below
+                old_sale = new_record['oldSaleAmount']['amount']
+                new_sale = new_record['saleAmount']['amount']
+                old_commission = new_record['oldCommissionAmount']['amount']
+                new_commission = new_record['commissionAmount']['amount']
+
                 # Create record for original amount
-                full_record = deepcopy(new_record)
-                full_record['saleAmount']['amount'] = new_record['oldSaleAmount']['amount']
-                full_record['commissionAmount']['amount'] = new_record['oldCommissionAmount']['amount']
+                full_record = self._clone_for_return(new_record)
+                full_record['saleAmount']['amount'] = old_sale
+                full_record['commissionAmount']['amount'] = old_commission
 
                 # Create record for return amount
-                return_record = deepcopy(new_record)
-                return_sales = -1 * \
-                    (full_record['saleAmount']['amount'] -
-                     new_record['saleAmount']['amount'])
-                return_commission = -1 * \
-                    (full_record['commissionAmount']['amount'] -
-                     new_record['commissionAmount']['amount'])
-                return_record['saleAmount']['amount'] = return_sales
-                return_record['commissionAmount']['amount'] = return_commission
+                return_record = self._clone_for_return(new_record)
+                return_record['saleAmount']['amount'] = new_sale - old_sale
+                return_record['commissionAmount']['amount'] = \
+                    new_commission - old_commission
                 if return_record['basketProducts']:
                     for product_record in return_record['basketProducts']:
                         product_record['quantity'] *= -1
 
-                output_records.append(full_record)
-                output_records.append(return_record)
+                yield full_record
+                yield return_record
 
             else:
-                output_records.append(new_record)
-        return output_records
+                yield new_record
 
     def _format_transaction(self, transaction: dict, entry: dict, country: str, retailer_map: list) -> dict:
         '''
@@ -338,10 +481,8 @@ class Transform(PipelineStep):
         transaction['sale_amount'] = entry['saleAmount']['amount']
         transaction['commission_amount'] = entry['commissionAmount']['amount']
         transaction['currency'] = entry['saleAmount']['currency']
-        transaction['referring_article'] = adt.get_canonical(
-            transaction['referring_url'])
-        transaction['referring_domain'] = adt.get_site(
-            transaction['referring_url'])
+        transaction['referring_article'], transaction['referring_domain'] = \
+            _parse_referring_url(transaction['referring_url'])
         transaction['affiliate_network'] = 'sample affiliate network'
         if entry['clickRefs']:
             transaction['click_id'] = entry['clickRefs'].get('clickRef')
@@ -367,35 +508,12 @@ class Transform(PipelineStep):
         '''
         if advertiser_id in retailer_map:
             return retailer_map[advertiser_id]
-        else:
-            # Base api url for advertiser details
-            advertiser_url = 'https://api.sample-network.com/publishers/{0}/programmedetails'
 
-            user_id = get_user_id(country)
-            request_url = advertiser_url.format(user_id)
-
-            # Set request params
-            params = {
-                'advertiserId': int(advertiser_id),
-                'accessToken': get_access_token(country)
-            }
-
-            # Send request
-            response = request_with_retries('GET', request_url, params=params)
-            if response.status_code != 200:
-                response.raise_for_status()
-
-            json_response = response.json()
-
-            # Grab retailer name
-            try:
-                raw_retailer_name = json_response['programmeInfo']['name']
-            except (TypeError, KeyError) as e:
-                raise KeyError(
-                    'no retailer info for advertiser ID: {0}'.format(advertiser_id))
-
-            retailer_map[advertiser_id] = raw_retailer_name.lower()
-            return raw_retailer_name.lower()
+        retailer_name = _fetch_retailer(int(advertiser_id), country)
+        retailer_map[advertiser_id] = retailer_name
+        # Persist the discovery so later iterations skip the lookup
+        _REDIS.hset(_retailer_map_key(country), advertiser_id, retailer_name)
+        return retailer_name
 
 
 class SlackMessage(PipelineStep):
@@ -410,13 +528,14 @@ class SlackMessage(PipelineStep):
             )
             for report in transformed_data
         ]
-        # Sort message components by reverse order to print transactions first
-        sorted(message_data, key=lambda x: x['report_type'], reverse=True)
-        for message in message_data:
-            slack_message(
-                f"{app.config['SUCCESS_ICON']} Pulled Data from Sample Network"
-                f"{country} {message['report_type']}! Total: {message['record_count']}"
-            )
+        # Sort message components by reverse order to print transactions
+        # first, then post one Slack message covering every report type
+        message_data.sort(key=lambda x: x['report_type'], reverse=True)
+        slack_message('\n'.join(
+            f"{app.config['SUCCESS_ICON']} Pulled Data from Sample Network"
+            f"{country} {message['report_type']}! Total: {message['record_count']}"
+            for message in message_data
+        ))
 
 
 iteration = Pipeline(
@@ -441,3 +560,21 @@ pipe = IterativePipeline(
     pipeline=iteration,
     stop_on_error=True
 )
+
+
+def run_parallel(arg_sets=default_arg_sets):
+    '''
+    Run the per-country pipelines concurrently instead of iterating
+    them sequentially. The countries are independent (separate
+    credentials and endpoints), so wall time drops to the slowest
+    country. Unlike the sequential pipe's stop_on_error, a failure
+    cannot interrupt siblings that are already running: they finish
+    before the first exception is re-raised.
+    '''
+    with ThreadPoolExecutor(max_workers=len(arg_sets)) as executor:
+        futures = [executor.submit(iteration.run, **arg_set)
+                   for arg_set in arg_sets]
+        for future in as_completed(futures):
+            # Surface the first failure; the executor exit still
+            # waits for the remaining countries to complete
+            future.result()
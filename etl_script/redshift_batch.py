@@ -0,0 +1,83 @@
+'''
+Batches Redshift COPY submissions. COPY has a high fixed cost per
+invocation (commit + scan setup), so instead of dispatching one load
+per S3 key, handlers enqueue their keys here and a single COPY per
+destination table is submitted against an S3 manifest.
+
+Pending keys are persisted in Redis rather than process memory, so
+partitions accumulate across handlers and processes: whichever flush
+runs first drains everything pending for a table into one manifest,
+and flushes that find nothing pending are no-ops.
+'''
+
+import json
+from datetime import datetime as dt
+
+import redis
+from flask import current_app as app
+
+from sample_framework.redshift_loader.main import pipe as redshift_loader
+
+_REDIS = redis.Redis.from_url(app.config['REDIS_URL'], decode_responses=True)
+
+# Registry of (table, compression) batches with keys pending in Redis
+_BATCH_REGISTRY_KEY = 'redshift_pending:batches'
+
+
+def _pending_list_key(batch: str) -> str:
+    '''
+    Redis key holding the pending S3 keys for one batch
+    '''
+    return f'redshift_pending:{batch}'
+
+
+def enqueue_copy(table_name: str, s3_key: str, compression: str = None) -> None:
+    '''
+    Register an uploaded S3 key for the next batched COPY submission
+    '''
+    batch = f'{table_name}:{compression or ""}'
+    pipe = _REDIS.pipeline()
+    pipe.rpush(_pending_list_key(batch), s3_key)
+    pipe.sadd(_BATCH_REGISTRY_KEY, batch)
+    pipe.execute()
+
+
+def flush_pending(context) -> None:
+    '''
+    Drain every pending batch, upload a manifest per destination table
+    covering all accumulated keys, and dispatch one COPY referencing it
+    '''
+    bucket = app.config['S3_BUCKET']
+    for batch in _REDIS.smembers(_BATCH_REGISTRY_KEY):
+        # Atomically take the pending keys so overlapping flushes
+        # cannot submit the same partition twice
+        pipe = _REDIS.pipeline()
+        pipe.lrange(_pending_list_key(batch), 0, -1)
+        pipe.delete(_pending_list_key(batch))
+        pipe.srem(_BATCH_REGISTRY_KEY, batch)
+        s3_keys = pipe.execute()[0]
+        if not s3_keys:
+            continue
+
+        table_name, _, compression = batch.rpartition(':')
+        manifest = {
+            'entries': [
+                {'url': f's3://{bucket}/{key}', 'mandatory': True}
+                for key in s3_keys
+            ]
+        }
+        manifest_key = f'manifests/{table_name}/{dt.now()}.json'
+        app.s3_client.put_object(
+            Bucket=bucket,
+            Key=manifest_key,
+            Body=json.dumps(manifest),
+            ContentType='application/json'
+        )
+        copy_args = {
+            'table_name': table_name,
+            's3_key': manifest_key,
+            'manifest': True
+        }
+        if compression:
+            copy_args['compression'] = compression
+        redshift_loader.apply_async((copy_args, context))
@@ -1,15 +1,19 @@
 '''This script extracts, transforms, and loads data from Shopify API to
 obtain daily product inventory levels'''
+import asyncio
 import gzip
-import json
+import io
 from datetime import datetime as dt
 from datetime import timedelta, timezone
 
+import httpx
+import orjson
+from boto3.s3.transfer import TransferConfig
 from flask import current_app as app
 
-from sample_framework.redshift_loader.main import pipe as redshift_loader
 from sample_framework.logging import get_cloud_logger, slack_message
-from sample_framework.requests import request_with_retries
+
+from .redshift_batch import enqueue_copy, flush_pending
 
 NAME = 'Shopify Inventory Data Extract'
 DESCRIPTION = 'Daily extraction of Shopify stock data'
@@ -29,10 +33,25 @@ COLUMN_MAP = {
     "quantity_on_hand": "available"
 }
 
+# Output/source field pairs resolved once rather than per row
+_PARSE_FIELDS = [(field, source)
+                 for field, source in COLUMN_MAP.items() if source]
+
 REDSHIFT_TABLE = "shopify_sample_table_name"
 
 UTC = timezone.utc
 
+MAX_CONCURRENT_REQUESTS = 8
+MAX_RETRIES = 3
+
+# Upload large payloads as concurrent multipart chunks
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
 
 def handle(context, task_id, **kwargs):
     '''
@@ -46,19 +65,15 @@ def handle(context, task_id, **kwargs):
     report_date = (dt.now() - timedelta(1)).date()
     data = extract_data()
     # Upload raw data to S3
-    put_s3(json.dumps(data), 'raw-data', report_date)
+    put_s3(orjson.dumps(data), 'raw-data', report_date)
     # Parse inventory data
     report = parse_inventory(data, report_date)
     # Upload transformed data to S3
     LOGGER.info('uploading data to S3')
-    copy_data = gzip.compress(
-        bytes(copy_format(report), 'utf-8'))
+    copy_data = copy_format(report)
     s3_key = put_s3(copy_data, 'transformed-data', report_date)
-    copy_args = {
-        'table_name': REDSHIFT_TABLE,
-        's3_key': s3_key
-    }
-    redshift_loader.apply_async((copy_args, context))
+    enqueue_copy(REDSHIFT_TABLE, s3_key)
+    flush_pending(context)
 
     slack_message(f":white_check_mark: {NAME} complete!")
 
@@ -81,42 +96,59 @@ def extract_data():
         "limit": 250
     }
 
-    # Extract data with parameters
-    res = request_with_retries(
-        'GET',
-        url=url,
-        headers=headers,
-        params=params
-    )
-
     # Extract data with parameters
     # Looping through pages
-    finished = False
+    return asyncio.run(_fetch_all(url, headers, params))
+
+
+async def _fetch_all(url: str, headers: dict, params: dict) -> list:
+    '''
+    Fetches every page of inventory, prefetching the next cursor page
+    while the current response is being parsed
+    '''
     inventory_levels = list()
-    while not finished:
-        res = request_with_retries(
-            'GET',
-            url=url,
-            headers=headers,
-            params=params
-        )
-        # Raise error if response code is not 200
-        res.raise_for_status()
-        # Return JSON format of response data
-        inventory_levels.extend(res.json()['inventory_levels'])
-        # Check for more pages
-        link_header = res.headers.get('Link')
-        if link_header is None or 'rel="next"' not in link_header:
-            finished = True
-            # If no 'Link' in response header, exit loop
-            # If 'Link' header does not have 'rel=next', exit loop
-        else:
-            rel_links = link_header.split(', ')
-            for link in rel_links:
-                if 'next' in link:
-                    next_link, _ = link.split(';')
-                    url = next_link.strip('<>')
-                    params = None
+    # Bound in-flight requests to stay within Shopify rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async with httpx.AsyncClient(http2=True) as client:
+
+        async def fetch_page(page_url, page_params):
+            # Retry rate limits, server errors, and transport failures
+            # with backoff, matching request_with_retries elsewhere
+            async with semaphore:
+                for attempt in range(MAX_RETRIES + 1):
+                    try:
+                        res = await client.get(
+                            page_url, headers=headers, params=page_params)
+                    except httpx.TransportError:
+                        if attempt == MAX_RETRIES:
+                            raise
+                        await asyncio.sleep(2 ** attempt)
+                        continue
+                    if (res.status_code == 429 or res.status_code >= 500) \
+                            and attempt < MAX_RETRIES:
+                        retry_after = res.headers.get('Retry-After')
+                        await asyncio.sleep(
+                            float(retry_after) if retry_after
+                            else 2 ** attempt)
+                        continue
+                    # Raise error if response code is not 200
+                    res.raise_for_status()
+                    return res
+
+        next_page = asyncio.create_task(fetch_page(url, params))
+        while next_page is not None:
+            res = await next_page
+            next_page = None
+            # Check for more pages via the parsed Link header
+            next_link = res.links.get('next')
+            if next_link is not None:
+                # Start fetching the next page while this
+                # response is parsed below
+                next_page = asyncio.create_task(
+                    fetch_page(next_link['url'], None))
+            # Return JSON format of response data
+            inventory_levels.extend(res.json()['inventory_levels'])
     return inventory_levels
 
 
@@ -125,28 +157,31 @@ def parse_inventory(stock_list: dict, report_date: dt.date) -> dict:
     Process data to transform product level records
     '''
     LOGGER.info('parsing Shopify daily stock data')
-    stock_data = list()
-    # Iterate through all inventory items
-    for product in stock_list:
-        stock_info = {
-            field: product.get(COLUMN_MAP[field])
-            if COLUMN_MAP[field] else COLUMN_MAP[field]
-            for field in COLUMN_MAP}
-        stock_info['report_date'] = f'{report_date}'
-        stock_info['created_at'] = dt.now().astimezone(
-            UTC).strftime('%Y-%m-%d %H:%M:%S')
-        stock_data.append(stock_info)
-    return stock_data
-
-
-def copy_format(data):
+    # Compute the shared timestamp and report date once for the batch
+    created_at = dt.now(UTC).strftime('%Y-%m-%d %H:%M:%S')
+    report_date_str = f'{report_date}'
+    return [
+        {field: product.get(source) for field, source in _PARSE_FIELDS}
+        | {'report_date': report_date_str, 'created_at': created_at}
+        for product in stock_list
+    ]
+
+
+def copy_format(data) -> bytes:
     '''
-    Format data prescribed by Redshift for Copy Command
+    Format data prescribed by Redshift for Copy Command,
+    streaming each record into a gzip buffer to avoid building
+    the full uncompressed payload in memory
     '''
-    return '\n'.join(json.dumps(item) for item in data)
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6) as gz:
+        for item in data:
+            gz.write(orjson.dumps(item))
+            gz.write(b'\n')
+    return buffer.getvalue()
 
 
-def put_s3(data: str, location: str, date: str):
+def put_s3(data: bytes, location: str, date: str):
     '''
     Upload data to appropriate S3 directory with given arguments
     '''
@@ -159,10 +194,15 @@ def put_s3(data: str, location: str, date: str):
         f'year={date.year}/month={date.month}/day={date.day}/' \
         f'sample_table_{date}_{now}.json{compression}'
 
-    app.s3_client.put_object(
+    extra_args = {'ContentType': 'application/json'}
+    if compression:
+        extra_args['ContentEncoding'] = 'gzip'
+
+    app.s3_client.upload_fileobj(
+        io.BytesIO(data),
         Bucket=app.config['S3_BUCKET'],
         Key=key,
-        Body=data,
-        ContentType='application/json'
+        ExtraArgs=extra_args,
+        Config=TRANSFER_CONFIG
     )
     return key
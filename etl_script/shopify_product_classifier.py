@@ -5,17 +5,21 @@ shopify_product_classification table in Redshift.
 
 import datetime as dt
 import gzip
-import json
+import io
 
+import orjson
+from boto3.s3.transfer import TransferConfig
 from flask import current_app as app
+from sqlalchemy import func
 
 from sample_framework.db import db
 from sample_framework.redshift import (ShopifyProductListing,
                                         ShopifyProductTags)
-from sample_framework.redshift_loader import pipe as redshift_loader
 from sample_framework.logging import get_cloud_logger, slack_message
 from sample_framework.product_classifier import classify
 
+from .redshift_batch import enqueue_copy, flush_pending
+
 NAME = 'Shopify Product Classifier'
 DESCRIPTION = 'Daily classification of Shopify products'
 ARGUMENTS = 'count'
@@ -23,6 +27,14 @@ GROUP = 'DTC'
 
 DESTINATION_TABLE = 'shopify_sample_table'
 
+# Upload large payloads as concurrent multipart chunks
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
 
 def handle(context, task_id, count=None, **kwargs) -> None:
     '''
@@ -49,20 +61,21 @@ def handle(context, task_id, count=None, **kwargs) -> None:
     transformed_products = transform_product_tags(
         tagged_products, new_products)
 
-    # Convert tagged product data to copy command format
-    copy_format = '\n'.join([json.dumps(item)
-                             for item in transformed_products])
-    copy_data = gzip.compress(bytes(copy_format, 'utf-8'))
+    # Convert tagged product data to copy command format, streaming
+    # each record into a gzip buffer to avoid building the full
+    # uncompressed payload in memory
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6) as gz:
+        for item in transformed_products:
+            gz.write(orjson.dumps(item))
+            gz.write(b'\n')
+    copy_data = buffer.getvalue()
 
     LOGGER.info('uploading tagged product data to S3...')
     s3_key = upload_data(copy_data)
     LOGGER.info('submitting load job')
-    copy_args = {
-        'table_name': DESTINATION_TABLE,
-        's3_key': s3_key,
-        'compression': 'GZIP'
-    }
-    redshift_loader.apply_async((copy_args, context))
+    enqueue_copy(DESTINATION_TABLE, s3_key, compression='GZIP')
+    flush_pending(context)
 
     # Log success message to slack
     slack_message(
@@ -90,34 +103,37 @@ def get_new_products(count: int) -> dict:
     Selects untagged products from the shopify_product_listing table
     and returns data for classification in the product widget format.
     '''
+    # NOTE: We remove the color from the product name by splitting on ~
+    # because the color names can cause problems for the classifier;
+    # split_part/trim push that work into the database
+    name_expr = func.trim(
+        func.split_part(ShopifyProductListing.parent_title, '~', 1)
+    ).label('name')
+
     query = db.session.query(
         ShopifyProductListing.variant_id,
         ShopifyProductListing.parent_id,
-        ShopifyProductListing.parent_title.label('name')
+        name_expr
     ).outerjoin(
         ShopifyProductTags,
         ShopifyProductListing.variant_id == ShopifyProductTags.variant_id
     ).filter(
-        # pylint: disable=singleton-comparison
-        ShopifyProductTags.vertical == None
+        ShopifyProductTags.vertical.is_(None)
     ).limit(
         count
     )
 
-    res = query.all()
-
     # Convert data to product widget format for
-    # compatibility with the utils.product_classifier module
-    # NOTE: We remove the color from the product name by spliting on ~
-    # because the color names can cause problems for the classifier
+    # compatibility with the utils.product_classifier module,
+    # streaming rows in batches instead of materializing them twice
     return [{
         'fields': {
             'brand': 'Sample Brand Name',
-            'name': name.split('~')[0].strip()
+            'name': name
         },
         'id': vid,
         'parent_id': pid
-    } for vid, pid, name in res]
+    } for vid, pid, name in query.yield_per(1000)]
 
 
 def upload_data(data: bytes) -> str:
@@ -129,11 +145,15 @@ def upload_data(data: bytes) -> str:
           f"year={now.year}/month={now.month}/day={now.day}/" \
           f"sample_table_{now}.json.gz"
 
-    app.s3_client.put_object(
+    app.s3_client.upload_fileobj(
+        io.BytesIO(data),
         Bucket=app.config['S3_BUCKET'],
         Key=key,
-        Body=data,
-        ContentType='application/json'
+        ExtraArgs={
+            'ContentType': 'application/json',
+            'ContentEncoding': 'gzip'
+        },
+        Config=TRANSFER_CONFIG
     )
 
     return key